@@ -0,0 +1,221 @@
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+
+try:
+    import tiktoken
+except ImportError:  # optional, fall back to a character based estimate
+    tiktoken = None
+
+# --- Budget Configuration ---
+# Limits are in tokens, 0 disables the check
+MAX_PROMPT_TOKENS = int(os.getenv("MAX_PROMPT_TOKENS", "2500"))
+MAX_REQUEST_TOKENS = int(os.getenv("MAX_REQUEST_TOKENS", "12000"))
+MAX_TENANT_TOKENS = int(os.getenv("MAX_TENANT_TOKENS", "30000"))
+# Seconds the per-tenant budget applies to, 60 matches a TPM quota
+TENANT_BUDGET_WINDOW = float(os.getenv("TENANT_BUDGET_WINDOW", "60"))
+
+# USD per 1M tokens: (input, output)
+MODEL_PRICING = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+}
+
+# Prompt compaction levels, applied in order until the prompt fits
+COMPACTION_LEVELS = ["none", "schema", "examples", "blueprint"]
+
+# Blueprint keys that do not affect the generated queries
+BLUEPRINT_METADATA_KEYS = ("description", "owner_team", "runbook_link", "name")
+
+CHARS_PER_TOKEN = 4
+
+
+class BudgetExceededError(Exception):
+    pass
+
+
+def count_tokens(text, model="gpt-4o"):
+    """
+    Count tokens locally, before the prompt is sent to the model. Exact when
+    tiktoken is installed, otherwise an estimate of CHARS_PER_TOKEN per token.
+    """
+    if tiktoken is not None:
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoding = tiktoken.get_encoding("o200k_base")
+        return len(encoding.encode(text))
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens):
+    """Estimate the USD cost of a completion."""
+    input_price, output_price = MODEL_PRICING.get(model, MODEL_PRICING["gpt-4o"])
+    return (prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000
+
+
+def compact_schema(schema):
+    """Strip SQL comments and redundant whitespace from DDL statements."""
+    schema = re.sub(r"--[^\n]*", "", schema)
+    schema = re.sub(r"/\*.*?\*/", "", schema, flags=re.DOTALL)
+    schema = re.sub(r"\s+", " ", schema)
+    schema = re.sub(r"\s*([(),;])\s*", r"\1", schema)
+    return schema.replace(";", ";\n").strip()
+
+
+def strip_yaml_comment(line):
+    """Remove a YAML comment, leaving `#` inside quoted values alone."""
+    quote = None
+    for i, char in enumerate(line):
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in ("'", '"'):
+            quote = char
+        elif char == "#" and (i == 0 or line[i - 1].isspace()):
+            return line[:i].rstrip()
+    return line.rstrip()
+
+
+def abbreviate_blueprint(blueprint):
+    """Drop comments and metadata keys that do not affect the generated queries."""
+    lines = []
+    skipping = False
+    for line in blueprint.splitlines():
+        if skipping and (line.startswith((" ", "\t")) or not line.strip()):
+            continue
+        skipping = False
+
+        key = line.split(":", 1)[0].strip()
+        if not line.startswith((" ", "\t")) and key in BLUEPRINT_METADATA_KEYS:
+            skipping = True
+            continue
+
+        line = strip_yaml_comment(line)
+        if line.strip():
+            lines.append(line)
+    return "\n".join(lines)
+
+
+def is_compacted(level, step):
+    """Whether a compaction step applies at the given level."""
+    return COMPACTION_LEVELS.index(level) >= COMPACTION_LEVELS.index(step)
+
+
+class TokenBudget:
+    """Per-request and per-tenant token accounting, with usage per stage."""
+
+    def __init__(
+        self,
+        max_prompt_tokens=MAX_PROMPT_TOKENS,
+        max_request_tokens=MAX_REQUEST_TOKENS,
+        max_tenant_tokens=MAX_TENANT_TOKENS,
+        tenant_window=TENANT_BUDGET_WINDOW,
+    ):
+        self.max_prompt_tokens = max_prompt_tokens
+        self.max_request_tokens = max_request_tokens
+        self.max_tenant_tokens = max_tenant_tokens
+        self.tenant_window = tenant_window
+        self._lock = threading.Lock()
+        self._requests = defaultdict(int)
+        # tenant -> [window start, tokens used in the window]
+        self._tenant_windows = {}
+        self._stages = defaultdict(
+            lambda: {
+                "calls": 0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "cost_usd": 0.0,
+                "compaction": defaultdict(int),
+            }
+        )
+
+    def remaining(self, tenant, request_id):
+        """Tokens still available for a request, or None if unlimited."""
+        limits = []
+        with self._lock:
+            if self.max_request_tokens:
+                limits.append(self.max_request_tokens - self._requests[request_id])
+            if self.max_tenant_tokens:
+                used = self._tenant_window(tenant)[1]
+                limits.append(self.max_tenant_tokens - used)
+        return min(limits) if limits else None
+
+    def _tenant_window(self, tenant):
+        """Current budget window of a tenant, a new one starts once it expires."""
+        now = time.monotonic()
+        # Tenant names come from the caller, forget the ones no longer active
+        expired = [
+            name
+            for name, (start, _) in self._tenant_windows.items()
+            if now - start >= self.tenant_window
+        ]
+        for name in expired:
+            del self._tenant_windows[name]
+        window = self._tenant_windows.get(tenant)
+        if window is None:
+            window = self._tenant_windows[tenant] = [now, 0]
+        return window
+
+    def fit(self, render, tenant, request_id, model="gpt-4o"):
+        """
+        Render the prompt at increasing compaction levels until it fits the budget.
+        Returns (prompt, level), raises BudgetExceededError if nothing fits.
+        """
+        remaining = self.remaining(tenant, request_id)
+        tokens = 0
+        for level in COMPACTION_LEVELS:
+            prompt = render(level)
+            tokens = count_tokens(prompt, model)
+            if self.max_prompt_tokens and tokens > self.max_prompt_tokens:
+                continue
+            if remaining is not None and tokens > remaining:
+                continue
+            return prompt, level
+
+        raise BudgetExceededError(
+            f"Prompt of {tokens} tokens exceeds budget "
+            f"(prompt limit: {self.max_prompt_tokens}, remaining: {remaining})"
+        )
+
+    def record(self, stage, tenant, request_id, model, usage, level="none"):
+        """Record the token usage reported by the model for one stage."""
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+        total = prompt_tokens + completion_tokens
+        with self._lock:
+            self._requests[request_id] += total
+            self._tenant_window(tenant)[1] += total
+            stats = self._stages[stage]
+            stats["calls"] += 1
+            stats["prompt_tokens"] += prompt_tokens
+            stats["completion_tokens"] += completion_tokens
+            stats["cost_usd"] += estimate_cost(model, prompt_tokens, completion_tokens)
+            stats["compaction"][level] += 1
+
+    def release(self, request_id):
+        """Forget the per-request counter once a request has completed."""
+        with self._lock:
+            self._requests.pop(request_id, None)
+
+    def reset_tenant(self, tenant):
+        """Start a new budget window for a tenant."""
+        with self._lock:
+            self._tenant_windows.pop(tenant, None)
+
+    def export(self):
+        """Export usage per stage (total since start) and per tenant (current window)."""
+        with self._lock:
+            stages = {
+                stage: {**stats, "compaction": dict(stats["compaction"])}
+                for stage, stats in self._stages.items()
+            }
+            now = time.monotonic()
+            tenants = {
+                tenant: tokens
+                for tenant, (start, tokens) in self._tenant_windows.items()
+                if now - start < self.tenant_window
+            }
+            return {"stages": stages, "tenants": tenants}
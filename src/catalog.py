@@ -0,0 +1,62 @@
+import hashlib
+import json
+import os
+
+from budget import compact_schema
+
+# --- Catalog Configuration ---
+CATALOG_DIR = os.getenv("CATALOG_DIR", "catalog")
+
+
+def schema_hash(schema):
+    """Version of a schema, ignoring comments and whitespace."""
+    return hashlib.sha256(compact_schema(schema).encode()).hexdigest()[:12]
+
+
+class Catalog:
+    """
+    Stored blueprints and their generated queries, one JSON file per blueprint.
+    Each schema version the entries were generated against is kept next to them.
+
+    Entry: {"id", "query", "tenant", "yaml", "queries": {dialect: query}, "schema_hash"}
+    """
+
+    def __init__(self, path=CATALOG_DIR):
+        self.path = path
+        os.makedirs(os.path.join(path, "blueprints"), exist_ok=True)
+        os.makedirs(os.path.join(path, "schemas"), exist_ok=True)
+
+    def save_schema(self, schema):
+        version = schema_hash(schema)
+        file_name = os.path.join(self.path, "schemas", f"{version}.sql")
+        if not os.path.exists(file_name):
+            with open(file_name, "w") as f:
+                f.write(schema)
+        return version
+
+    def load_schema(self, version):
+        file_name = os.path.join(self.path, "schemas", f"{version}.sql")
+        if not os.path.exists(file_name):
+            return None
+        with open(file_name) as f:
+            return f.read()
+
+    def save(self, entry):
+        file_name = os.path.join(self.path, "blueprints", f"{entry['id']}.json")
+        with open(file_name + ".tmp", "w") as f:
+            json.dump(entry, f, indent=2)
+        os.replace(file_name + ".tmp", file_name)
+
+    def load(self, entry_id):
+        file_name = os.path.join(self.path, "blueprints", f"{entry_id}.json")
+        if not os.path.exists(file_name):
+            return None
+        with open(file_name) as f:
+            return json.load(f)
+
+    def entries(self):
+        folder = os.path.join(self.path, "blueprints")
+        for file_name in sorted(os.listdir(folder)):
+            if file_name.endswith(".json"):
+                with open(os.path.join(folder, file_name)) as f:
+                    yield json.load(f)
@@ -0,0 +1,86 @@
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# --- Timeout Configuration ---
+# Seconds, per LLM activity and per workflow
+ACTIVITY_TIMEOUT = float(os.getenv("ACTIVITY_TIMEOUT", "60"))
+WORKFLOW_TIMEOUT = float(os.getenv("WORKFLOW_TIMEOUT", "180"))
+
+# --- Hedged Requests ---
+# A duplicate LLM call is sent after the stage's p95 latency, first answer wins
+HEDGE_REQUESTS = os.getenv("HEDGE_REQUESTS", "false").lower() == "true"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "15"))
+HEDGE_MIN_SAMPLES = 20
+LATENCY_WINDOW = 200
+
+executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="llm")
+
+
+class LatencyTracker:
+    """Rolling latency samples per stage."""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self._lock = threading.Lock()
+        self._samples = defaultdict(lambda: deque(maxlen=window))
+
+    def record(self, stage, seconds):
+        with self._lock:
+            self._samples[stage].append(seconds)
+
+    def percentile(self, stage, percentile):
+        with self._lock:
+            samples = sorted(self._samples[stage])
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        index = min(len(samples) - 1, int(len(samples) * percentile / 100))
+        return samples[index]
+
+    def hedge_delay(self, stage):
+        delay = self.percentile(stage, HEDGE_PERCENTILE)
+        return HEDGE_DEFAULT_DELAY if delay is None else delay
+
+
+def hedged_call(call, stage, tracker, hedge=HEDGE_REQUESTS, timeout=ACTIVITY_TIMEOUT):
+    """
+    Run call() with a deadline. When hedging, a duplicate call is started if the
+    first one is slower than the stage's p95 latency and the first answer is kept.
+    Raises TimeoutError if no call completes before the deadline.
+    """
+    deadline = time.monotonic() + timeout
+
+    def timed():
+        started = time.monotonic()
+        result = call()
+        tracker.record(stage, time.monotonic() - started)
+        return result
+
+    pending = {executor.submit(timed)}
+    hedged = not hedge
+    error = None
+    while pending:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        wait_for = remaining if hedged else min(remaining, tracker.hedge_delay(stage))
+        done, pending = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+
+        if not hedged:
+            # Hedge on a slow call, or retry right away on a failed one
+            print(f"Hedging {stage} request")
+            pending.add(executor.submit(timed))
+            hedged = True
+
+    for future in pending:
+        future.cancel()
+    if error is not None and not pending:
+        raise error
+    raise TimeoutError(f"{stage} did not complete within {timeout:g}s")
@@ -0,0 +1,606 @@
+import re
+
+import yaml
+
+# Intermediate query representation (IR), built once from a YAML blueprint and
+# lowered to each dialect locally. It is a plain dict so it can be passed between
+# workflow activities as JSON:
+#
+#   {
+#       "id": "MON-...",
+#       "table": "api_requests",
+#       "columns": {"endpoint": "VARCHAR", ...},
+#       "time_column": "timestamp",
+#       "time_window": {"value": 15, "unit": "m"},
+#       "group_by": ["endpoint"],
+#       "filters": [{"column": "method", "op": "=", "value": "GET"}],
+#       "aggregates": [{"alias": "agg_0", "func": "count", "column": None, "where": None}],
+#       "metrics": [{"name": "request_count", "expr": {"agg": "agg_0"}}],
+#       "thresholds": [{"metric": "request_count", "op": ">=", "value": 10}],
+#   }
+#
+# Metric expressions are trees of {"num": 5}, {"agg": "agg_0"}, {"neg": expr} and
+# {"op": "/", "left": expr, "right": expr}.
+
+AGGREGATE_FUNCTIONS = {
+    "avg": "avg",
+    "average": "avg",
+    "mean": "avg",
+    "count": "count",
+    "sum": "sum",
+    "total": "sum",
+    "min": "min",
+    "minimum": "min",
+    "max": "max",
+    "maximum": "max",
+}
+
+COMPARISON_OPERATORS = {
+    ">": ">",
+    ">=": ">=",
+    "<": "<",
+    "<=": "<=",
+    "=": "=",
+    "==": "=",
+    "!=": "!=",
+    "<>": "!=",
+    "gt": ">",
+    "gte": ">=",
+    "lt": "<",
+    "lte": "<=",
+    "eq": "=",
+    "ne": "!=",
+    "greater_than": ">",
+    "less_than": "<",
+    "above": ">",
+    "below": "<",
+}
+
+NUMERIC_TYPES = ("INT", "DECIMAL", "NUMERIC", "REAL", "FLOAT", "DOUBLE")
+TIME_UNITS = {"s": "seconds", "m": "minutes", "h": "hours", "d": "days", "w": "weeks"}
+
+SPL_INDEX = "main"
+
+# Blueprint keys the IR understands, anything else goes to the LLM fallback
+BLUEPRINT_KEYS = {
+    "id",
+    "name",
+    "description",
+    "target_entity",
+    "conditions",
+    "filters",
+    "time_window",
+    "minimum_traffic_threshold",
+    "severity",
+    "owner_team",
+    "runbook_link",
+}
+CONDITION_KEYS = {"metric", "calculation", "aggregation", "threshold", "description"}
+MINIMUM_TRAFFIC_KEYS = {"metric", "window", "threshold"}
+
+# Metric names become aliases in every dialect, so they must be plain identifiers
+# that are not keywords or functions in any of them
+RESERVED_WORDS = {
+    "all", "and", "as", "asc", "avg", "between", "bool", "by", "case", "count",
+    "desc", "distinct", "else", "end", "eval", "false", "from", "group", "having",
+    "ignoring", "in", "is", "join", "like", "limit", "max", "min", "not", "null",
+    "offset", "on", "or", "order", "search", "select", "stats", "sum", "table",
+    "then", "timestamp", "true", "union", "when", "where", "without",
+}  # fmt: skip
+
+TOKEN_PATTERN = re.compile(
+    r"\s*(?:(?P<num>\d+(?:\.\d+)?)"
+    r"|(?P<str>'[^']*'|\"[^\"]*\")"
+    r"|(?P<ident>[A-Za-z_][\w.]*)"
+    r"|(?P<cmp>>=|<=|!=|<>|==|=|>|<)"
+    r"|(?P<sym>[-+*/(),]))"
+)
+
+
+class UnsupportedQueryError(Exception):
+    pass
+
+
+def parse_schema(ddl):
+    """Parse CREATE TABLE statements into {table: {column: type}}."""
+    tables = {}
+    ddl = re.sub(r"--[^\n]*", "", ddl)
+    for match in re.finditer(
+        r"CREATE TABLE\s+(?:IF NOT EXISTS\s+)?(\w+)\s*\((.*?)\);",
+        ddl,
+        re.DOTALL | re.IGNORECASE,
+    ):
+        columns = {}
+        for definition in re.split(r",(?![^(]*\))", match.group(2)):
+            parts = definition.split()
+            if not parts or parts[0].upper() in (
+                "PRIMARY",
+                "FOREIGN",
+                "UNIQUE",
+                "CONSTRAINT",
+            ):
+                continue
+            column_type = parts[1].upper() if len(parts) > 1 else ""
+            columns[parts[0]] = re.sub(r"\(.*", "", column_type)
+        tables[match.group(1)] = columns
+    return tables
+
+
+def is_numeric(column_type):
+    return any(numeric in column_type for numeric in NUMERIC_TYPES)
+
+
+def tokenize(text):
+    tokens = []
+    position = 0
+    text = text.strip()
+    while position < len(text):
+        match = TOKEN_PATTERN.match(text, position)
+        if not match or match.end() == position:
+            raise UnsupportedQueryError(f"Cannot parse expression: {text}")
+        kind = match.lastgroup
+        tokens.append((kind, match.group(kind)))
+        position = match.end()
+    return tokens
+
+
+def parse_literal(kind, value):
+    if kind == "num":
+        return float(value) if "." in value else int(value)
+    if kind == "str":
+        return value[1:-1]
+    raise UnsupportedQueryError(f"Expected a literal, got: {value}")
+
+
+class ExpressionParser:
+    """Recursive descent parser for blueprint calculations, e.g. `count(x >= 400) / count(*) * 100`."""
+
+    def __init__(self, text, table, columns, aggregates):
+        self.text = text
+        self.tokens = tokenize(text)
+        self.position = 0
+        self.table = table
+        self.columns = columns
+        self.aggregates = aggregates
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def take(self, expected=None):
+        kind, value = self.peek()
+        if kind is None or (expected is not None and value != expected):
+            raise UnsupportedQueryError(f"Unexpected end of expression: {self.text}")
+        self.position += 1
+        return kind, value
+
+    def parse(self):
+        expr = self.expression()
+        if self.peek()[0] is not None:
+            raise UnsupportedQueryError(f"Unexpected token in expression: {self.text}")
+        return expr
+
+    def expression(self):
+        left = self.term()
+        while self.peek()[1] in ("+", "-"):
+            _, op = self.take()
+            left = {"op": op, "left": left, "right": self.term()}
+        return left
+
+    def term(self):
+        left = self.factor()
+        while self.peek()[1] in ("*", "/"):
+            _, op = self.take()
+            left = {"op": op, "left": left, "right": self.factor()}
+        return left
+
+    def factor(self):
+        kind, value = self.peek()
+        if kind == "num":
+            self.take()
+            return {"num": parse_literal(kind, value)}
+        if value == "-":
+            self.take()
+            return {"neg": self.factor()}
+        if value == "(":
+            self.take()
+            expr = self.expression()
+            self.take(")")
+            return expr
+        if kind == "ident" and value.lower() in AGGREGATE_FUNCTIONS:
+            return self.aggregate()
+        # References to other metrics or bare columns can not be lowered locally
+        raise UnsupportedQueryError(f"Unsupported term '{value}' in: {self.text}")
+
+    def column(self, name):
+        table, _, column = name.rpartition(".")
+        if (table and table != self.table) or column not in self.columns:
+            raise UnsupportedQueryError(f"Unknown column '{name}' for {self.table}")
+        return column
+
+    def aggregate(self):
+        _, name = self.take()
+        func = AGGREGATE_FUNCTIONS[name.lower()]
+        self.take("(")
+        column = None
+        where = None
+        if self.peek()[1] == "*":
+            self.take()
+        else:
+            column = self.column(self.take()[1])
+            if self.peek()[0] == "cmp":
+                _, op = self.take()
+                literal = parse_literal(*self.take())
+                where = {
+                    "column": column,
+                    "op": COMPARISON_OPERATORS[op],
+                    "value": literal,
+                }
+                column = None
+        self.take(")")
+
+        if func != "count" and (column is None or where is not None):
+            raise UnsupportedQueryError(
+                f"Unsupported aggregation '{name}' in: {self.text}"
+            )
+
+        aggregate = {"func": func, "column": column, "where": where}
+        for existing in self.aggregates:
+            if {key: existing[key] for key in aggregate} == aggregate:
+                return {"agg": existing["alias"]}
+        aggregate = {"alias": f"agg_{len(self.aggregates)}", **aggregate}
+        self.aggregates.append(aggregate)
+        return {"agg": aggregate["alias"]}
+
+
+def check_metric_name(name, columns, metrics):
+    if (
+        not isinstance(name, str)
+        or not re.fullmatch(r"[A-Za-z_]\w*", name)
+        or name.lower() in RESERVED_WORDS
+        or name.startswith("agg_")
+        or name in columns
+        or name in (metric["name"] for metric in metrics)
+    ):
+        raise UnsupportedQueryError(f"Unsupported metric name: {name}")
+
+
+def parse_time_window(value):
+    match = re.fullmatch(r"(\d+)\s*([smhdw])", str(value).strip().lower())
+    if not match:
+        raise UnsupportedQueryError(f"Unsupported time window: {value}")
+    return {"value": int(match.group(1)), "unit": match.group(2)}
+
+
+def parse_threshold(threshold):
+    if isinstance(threshold, dict):
+        op = str(threshold.get("condition", threshold.get("operator", ">"))).lower()
+        value = threshold.get("value")
+    else:
+        op, value = ">", threshold
+    if op not in COMPARISON_OPERATORS or not isinstance(value, (int, float)):
+        raise UnsupportedQueryError(f"Unsupported threshold: {threshold}")
+    return COMPARISON_OPERATORS[op], value
+
+
+def parse_filter(item, table, columns):
+    if isinstance(item, dict):
+        column = item.get("field", item.get("column"))
+        op = str(item.get("operator", item.get("condition", "="))).lower()
+        value = item.get("value")
+        # bool is an int subclass, but True is not a label or column value
+        if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+            raise UnsupportedQueryError(f"Unsupported filter value: {item}")
+    else:
+        tokens = tokenize(str(item))
+        if len(tokens) != 3 or tokens[1][0] != "cmp":
+            raise UnsupportedQueryError(f"Unsupported filter: {item}")
+        column, op, value = tokens[0][1], tokens[1][1], parse_literal(*tokens[2])
+
+    column = str(column).rpartition(".")[2]
+    if column not in columns or op not in COMPARISON_OPERATORS:
+        raise UnsupportedQueryError(f"Unsupported filter for {table}: {item}")
+    return {"column": column, "op": COMPARISON_OPERATORS[op], "value": value}
+
+
+def parse_filters(filters, table, columns):
+    if not isinstance(filters, list):
+        raise UnsupportedQueryError(f"Unsupported filters: {filters}")
+    return [parse_filter(item, table, columns) for item in filters]
+
+
+def build_ir(blueprint, schema):
+    """Build the intermediate query representation from a YAML blueprint."""
+    # Models sometimes wrap the blueprint in a code fence anyway
+    blueprint = re.sub(r"^\s*```\w*\s*\n|\n\s*```\s*$", "", blueprint)
+    try:
+        spec = yaml.safe_load(blueprint)
+    except yaml.YAMLError as e:
+        raise UnsupportedQueryError(f"Invalid YAML blueprint: {e}")
+    if not isinstance(spec, dict):
+        raise UnsupportedQueryError("YAML blueprint is not a mapping")
+    unknown = set(spec) - BLUEPRINT_KEYS
+    if unknown:
+        raise UnsupportedQueryError(f"Unsupported blueprint keys: {sorted(unknown)}")
+
+    tables = parse_schema(schema)
+    table, _, entity = str(spec.get("target_entity", "")).partition(".")
+    if table not in tables:
+        raise UnsupportedQueryError(
+            f"Unknown target entity: {spec.get('target_entity')}"
+        )
+    columns = tables[table]
+
+    group_by = [entity] if entity else []
+    if any(column not in columns for column in group_by):
+        raise UnsupportedQueryError(f"Unknown group-by column: {entity}")
+
+    time_columns = [name for name, kind in columns.items() if kind == "TIMESTAMP"]
+    if not time_columns:
+        raise UnsupportedQueryError(f"No timestamp column in {table}")
+    time_column = "timestamp" if "timestamp" in time_columns else time_columns[0]
+
+    aggregates = []
+    metrics = []
+    thresholds = []
+
+    conditions = spec.get("conditions") or []
+    if isinstance(conditions, dict):
+        conditions = [conditions]
+    time_window = parse_time_window(spec.get("time_window", "15m"))
+    minimum = spec.get("minimum_traffic_threshold")
+    if minimum is not None:
+        if not isinstance(minimum, dict) or set(minimum) - MINIMUM_TRAFFIC_KEYS:
+            raise UnsupportedQueryError(f"Unsupported minimum traffic: {minimum}")
+        # The count is taken over the same window as the conditions
+        if "window" in minimum and parse_time_window(minimum["window"]) != time_window:
+            raise UnsupportedQueryError(
+                f"Unsupported minimum traffic window: {minimum['window']}"
+            )
+        conditions = conditions + [
+            {
+                "metric": minimum.get("metric", "request_count"),
+                "calculation": "count(*)",
+                "threshold": {"value": minimum.get("threshold"), "condition": ">="},
+            }
+        ]
+    if not conditions:
+        raise UnsupportedQueryError("YAML blueprint has no conditions")
+
+    if not isinstance(conditions, list):
+        raise UnsupportedQueryError(f"Unsupported conditions: {conditions}")
+
+    for condition in conditions:
+        if not isinstance(condition, dict) or set(condition) - CONDITION_KEYS:
+            raise UnsupportedQueryError(f"Unsupported condition: {condition}")
+        name = condition.get("metric")
+        calculation = condition.get("calculation") or condition.get("aggregation")
+        if not name or not calculation:
+            raise UnsupportedQueryError(f"Unsupported condition: {condition}")
+        check_metric_name(name, columns, metrics)
+        parser = ExpressionParser(str(calculation), table, columns, aggregates)
+        metrics.append({"name": name, "expr": parser.parse()})
+        if "threshold" in condition:
+            op, value = parse_threshold(condition["threshold"])
+            thresholds.append({"metric": name, "op": op, "value": value})
+
+    return {
+        "id": spec.get("id"),
+        "table": table,
+        "columns": columns,
+        "time_column": time_column,
+        "time_window": time_window,
+        "group_by": group_by,
+        "filters": parse_filters(spec.get("filters") or [], table, columns),
+        "aggregates": aggregates,
+        "metrics": metrics,
+        "thresholds": thresholds,
+    }
+
+
+# --- Dialect Code Generators ---
+
+
+def render_expr(expr, render_agg, render_num=str):
+    if "num" in expr:
+        return render_num(expr["num"])
+    if "agg" in expr:
+        return render_agg(expr["agg"])
+    if "neg" in expr:
+        return f"-{render_expr(expr['neg'], render_agg, render_num)}"
+    left = render_expr(expr["left"], render_agg, render_num)
+    right = render_expr(expr["right"], render_agg, render_num)
+    return f"({left} {expr['op']} {right})"
+
+
+def sql_literal(value):
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return str(value)
+
+
+def sql_condition(condition):
+    op = "<>" if condition["op"] == "!=" else condition["op"]
+    return f"{condition['column']} {op} {sql_literal(condition['value'])}"
+
+
+def sql_expr(expr):
+    if expr.get("op") == "/":
+        left = sql_expr(expr["left"])
+        right = sql_expr(expr["right"])
+        # Avoid integer division and division by zero
+        return f"(1.0 * {left} / NULLIF({right}, 0))"
+    if "op" in expr:
+        return f"({sql_expr(expr['left'])} {expr['op']} {sql_expr(expr['right'])})"
+    if "neg" in expr:
+        return f"-{sql_expr(expr['neg'])}"
+    return render_expr(expr, lambda alias: alias)
+
+
+def sql_aggregate(aggregate):
+    func = aggregate["func"].upper()
+    if aggregate["where"]:
+        return f"COUNT(CASE WHEN {sql_condition(aggregate['where'])} THEN 1 END)"
+    return f"{func}({aggregate['column'] or '*'})"
+
+
+def to_sql(ir, time_predicate):
+    group_by = ir["group_by"]
+    select = [*group_by] + [
+        f"{sql_aggregate(aggregate)} AS {aggregate['alias']}"
+        for aggregate in ir["aggregates"]
+    ]
+    where = [time_predicate] + [sql_condition(item) for item in ir["filters"]]
+    metrics = [*group_by] + [
+        f"{sql_expr(metric['expr'])} AS {metric['name']}" for metric in ir["metrics"]
+    ]
+    having = [
+        f"{item['metric']} {'<>' if item['op'] == '!=' else item['op']} {item['value']}"
+        for item in ir["thresholds"]
+    ]
+
+    query = "WITH aggregated AS (\n    SELECT\n        "
+    query += ",\n        ".join(select)
+    query += f"\n    FROM\n        {ir['table']}\n    WHERE\n        "
+    query += "\n        AND ".join(where)
+    if group_by:
+        query += "\n    GROUP BY\n        " + ", ".join(group_by)
+    query += "\n),\nmetrics AS (\n    SELECT\n        "
+    query += ",\n        ".join(metrics)
+    query += "\n    FROM\n        aggregated\n)\nSELECT\n    *\nFROM\n    metrics"
+    if having:
+        query += "\nWHERE\n    " + "\n    AND ".join(having)
+    return query + ";"
+
+
+def to_sqlite(ir):
+    window = ir["time_window"]
+    amount = window["value"] * (7 if window["unit"] == "w" else 1)
+    unit = "days" if window["unit"] == "w" else TIME_UNITS[window["unit"]]
+    # init.py stores local timestamps
+    return to_sql(
+        ir,
+        f"{ir['time_column']} >= datetime('now', 'localtime', '-{amount} {unit}')",
+    )
+
+
+def to_postgres(ir):
+    window = ir["time_window"]
+    return to_sql(
+        ir,
+        f"{ir['time_column']} >= NOW() - INTERVAL '{window['value']} {TIME_UNITS[window['unit']]}'",
+    )
+
+
+def to_promql(ir):
+    """
+    Tables are exported as one series per numeric column (`<table>_<column>`),
+    other columns are labels.
+    """
+    columns = ir["columns"]
+    numeric = [name for name, kind in columns.items() if is_numeric(kind)]
+    labels = [name for name, kind in columns.items() if not is_numeric(kind)]
+    if any(column not in labels for column in ir["group_by"]):
+        raise UnsupportedQueryError("PromQL can only group by label columns")
+
+    matchers = []
+    for item in ir["filters"]:
+        if item["column"] not in labels or item["op"] not in ("=", "!="):
+            raise UnsupportedQueryError(f"Unsupported PromQL filter: {item}")
+        value = str(item["value"]).replace("\\", "\\\\").replace('"', '\\"')
+        matchers.append(f'{item["column"]}{item["op"]}"{value}"')
+    selector = "{" + ",".join(matchers) + "}" if matchers else ""
+    window = f"[{ir['time_window']['value']}{ir['time_window']['unit']}]"
+    by = f" by ({', '.join(ir['group_by'])})" if ir["group_by"] else ""
+
+    rendered = {}
+    for aggregate in ir["aggregates"]:
+        if aggregate["where"]:
+            raise UnsupportedQueryError("PromQL can not count on sample values")
+        column = aggregate["column"] or (numeric[0] if numeric else None)
+        if column not in numeric:
+            raise UnsupportedQueryError(f"No numeric series for {aggregate}")
+        series = f"{ir['table']}_{column}{selector}{window}"
+        func = aggregate["func"]
+        if func == "avg":
+            rendered[aggregate["alias"]] = (
+                f"(sum{by} (sum_over_time({series})) / sum{by} (count_over_time({series})))"
+            )
+        elif func == "count":
+            rendered[aggregate["alias"]] = f"sum{by} (count_over_time({series}))"
+        else:
+            rendered[aggregate["alias"]] = f"{func}{by} ({func}_over_time({series}))"
+
+    metrics = {
+        metric["name"]: render_expr(metric["expr"], rendered.get)
+        for metric in ir["metrics"]
+    }
+    if not ir["thresholds"]:
+        return "\n".join(metrics.values())
+    op = {"=": "=="}
+    return "\nand\n".join(
+        f"{metrics[item['metric']]} {op.get(item['op'], item['op'])} {item['value']}"
+        for item in ir["thresholds"]
+    )
+
+
+def spl_literal(value):
+    if isinstance(value, str):
+        return '"' + value.replace('"', '\\"') + '"'
+    return str(value)
+
+
+def to_spl(ir):
+    window = ir["time_window"]
+    search = [f"index={SPL_INDEX}", f"sourcetype={ir['table']}"]
+    search.append(f"earliest=-{window['value']}{window['unit']}")
+    search += [
+        f"{item['column']}{item['op']}{spl_literal(item['value'])}"
+        for item in ir["filters"]
+    ]
+
+    stats = []
+    for aggregate in ir["aggregates"]:
+        where = aggregate["where"]
+        if where:
+            op = "==" if where["op"] == "=" else where["op"]
+            expr = f"count(eval({where['column']}{op}{spl_literal(where['value'])}))"
+        elif aggregate["column"]:
+            expr = f"{aggregate['func']}({aggregate['column']})"
+        else:
+            expr = "count"
+        stats.append(f"{expr} AS {aggregate['alias']}")
+
+    query = "search " + " ".join(search)
+    query += "\n| stats " + ", ".join(stats)
+    if ir["group_by"]:
+        query += " by " + ", ".join(ir["group_by"])
+    query += "\n| eval " + ", ".join(
+        f"{metric['name']}={render_expr(metric['expr'], lambda alias: alias)}"
+        for metric in ir["metrics"]
+    )
+    if ir["thresholds"]:
+        op = {"=": "=="}
+        query += "\n| where " + " AND ".join(
+            f"{item['metric']}{op.get(item['op'], item['op'])}{item['value']}"
+            for item in ir["thresholds"]
+        )
+    fields = ir["group_by"] + [metric["name"] for metric in ir["metrics"]]
+    return query + "\n| table " + ", ".join(fields)
+
+
+# Dialects without a generator here (e.g. KQL) are always generated by the LLM
+GENERATORS = {
+    "sqlite": to_sqlite,
+    "postgres": to_postgres,
+    "promql": to_promql,
+    "spl": to_spl,
+}
+
+
+def lower(ir, dialect):
+    """Lower the IR to a dialect, raises UnsupportedQueryError if it can not."""
+    if ir is None or dialect not in GENERATORS:
+        raise UnsupportedQueryError(f"No local generator for {dialect}")
+    return GENERATORS[dialect](ir)
@@ -0,0 +1,281 @@
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from catalog import schema_hash
+from query_ir import GENERATORS, UnsupportedQueryError, build_ir, lower, parse_schema
+
+# --- Migration Configuration ---
+REGENERATE_CONCURRENCY = int(os.getenv("REGENERATE_CONCURRENCY", "4"))
+
+# Migration actions, from cheapest to most expensive
+SKIP = "skip"  # entry does not reference a changed table
+PATCH = "patch"  # declared renames and local generators, no LLM call
+REGENERATE = "regenerate"  # removed, ambiguous or retyped references
+
+
+def diff_schemas(old_schema, new_schema, renames=None):
+    """
+    Compare two schema versions, table by table and column by column.
+    Renames are never guessed, they must be declared as {table: {old: new}};
+    any other dropped column counts as removed.
+    """
+    renames = renames or {}
+    old_tables = parse_schema(old_schema)
+    new_tables = parse_schema(new_schema)
+    diff = {
+        "tables": old_tables,
+        "added_tables": sorted(set(new_tables) - set(old_tables)),
+        "removed_tables": sorted(set(old_tables) - set(new_tables)),
+        "added_columns": {},
+        "removed_columns": {},
+        "changed_columns": {},
+        "renamed_columns": {},
+    }
+
+    for table in sorted(set(old_tables) & set(new_tables)):
+        old_columns = old_tables[table]
+        new_columns = new_tables[table]
+        added = [c for c in new_columns if c not in old_columns]
+        removed = [c for c in old_columns if c not in new_columns]
+        changed = {
+            c: [old_columns[c], new_columns[c]]
+            for c in old_columns
+            if c in new_columns and old_columns[c] != new_columns[c]
+        }
+
+        renamed = {
+            old: new
+            for old, new in renames.get(table, {}).items()
+            if old in removed and new in added
+        }
+        if renamed:
+            diff["renamed_columns"][table] = renamed
+            added = [c for c in added if c not in renamed.values()]
+            removed = [c for c in removed if c not in renamed]
+
+        if added:
+            diff["added_columns"][table] = added
+        if removed:
+            diff["removed_columns"][table] = removed
+        if changed:
+            diff["changed_columns"][table] = changed
+    return diff
+
+
+def changed_tables(diff):
+    tables = set(diff["removed_tables"])
+    for key in (
+        "added_columns",
+        "removed_columns",
+        "changed_columns",
+        "renamed_columns",
+    ):
+        tables.update(diff[key])
+    return tables
+
+
+def identifiers(entry):
+    text = "\n".join([entry["yaml"], *entry["queries"].values()])
+    return set(re.findall(r"[A-Za-z_]\w*", text))
+
+
+def rename_references(entry, diff):
+    """
+    Rewrite declared renames in the blueprint and its queries, returns the new
+    (yaml, queries) and the old names still referenced after the rewrite.
+    """
+    names = identifiers(entry)
+    yaml = entry["yaml"]
+    queries = dict(entry["queries"])
+    leftover = []
+    for table, columns in diff["renamed_columns"].items():
+        if table not in names:
+            continue
+        for old, new in columns.items():
+            # Qualified references to this table, or bare ones (checked by plan_entry)
+            pattern = re.compile(
+                rf"(?<![\w.])(?:{re.escape(table)}\.)?{re.escape(old)}\b"
+            )
+
+            def rename(match, table=table, new=new):
+                prefix = f"{table}." if match.group(0).startswith(f"{table}.") else ""
+                return prefix + new
+
+            yaml = pattern.sub(rename, yaml)
+            queries = {
+                dialect: pattern.sub(rename, query)
+                for dialect, query in queries.items()
+            }
+            # e.g. an alias qualified reference (ar.old) is not rewritten
+            remaining = re.compile(rf"\b{re.escape(old)}\b")
+            if any(remaining.search(text) for text in [yaml, *queries.values()]):
+                leftover.append(f"{table}.{old}")
+    return yaml, queries, leftover
+
+
+def local_dialects(yaml, schema):
+    """Dialects the blueprint can be lowered to without the LLM."""
+    try:
+        ir = build_ir(yaml, schema)
+    except UnsupportedQueryError:
+        return set()
+    dialects = set()
+    for dialect in GENERATORS:
+        try:
+            lower(ir, dialect)
+            dialects.add(dialect)
+        except UnsupportedQueryError:
+            pass
+    return dialects
+
+
+def plan_entry(entry, diff, schema):
+    """Work out how an entry is migrated, returns (action, reason)."""
+    names = identifiers(entry)
+    tables = {table for table in changed_tables(diff) if table in names}
+    if not tables:
+        return SKIP, "no changed table referenced"
+
+    removed = [table for table in diff["removed_tables"] if table in names]
+    for table, columns in diff["removed_columns"].items():
+        removed += [f"{table}.{c}" for c in columns if table in tables and c in names]
+    if removed:
+        return REGENERATE, f"references removed {', '.join(removed)}"
+
+    renamed = []
+    for table, columns in diff["renamed_columns"].items():
+        for old, new in columns.items():
+            if table not in tables or old not in names:
+                continue
+            # A bare column name can only be rewritten if it is unambiguous
+            others = [
+                other
+                for other, other_columns in diff["tables"].items()
+                if other != table and other in names and old in other_columns
+            ]
+            if others:
+                return REGENERATE, (
+                    f"rename {table}.{old} is ambiguous with {', '.join(others)}"
+                )
+            renamed.append(f"{table}.{old}->{new}")
+    yaml, _, leftover = rename_references(entry, diff)
+    if leftover:
+        return REGENERATE, f"references to {', '.join(leftover)} can not be renamed"
+
+    retyped = [
+        f"{table}.{column}"
+        for table, columns in diff["changed_columns"].items()
+        if table in tables
+        for column in columns
+        if column in names
+    ]
+    if retyped:
+        # Stored LLM queries may depend on the old type, they are only safe to
+        # keep if every dialect is generated again locally
+        stale = sorted(set(entry["queries"]) - local_dialects(yaml, schema))
+        if stale:
+            return REGENERATE, (
+                f"type of {', '.join(retyped)} changed, "
+                f"{', '.join(stale)} can not be generated locally"
+            )
+
+    reasons = []
+    if renamed:
+        reasons.append(f"renames {', '.join(renamed)}")
+    if retyped:
+        reasons.append(f"type changes to {', '.join(retyped)}")
+    if not reasons:
+        reasons.append(f"additive changes to {', '.join(sorted(tables))}")
+    return PATCH, "; ".join(reasons)
+
+
+def patch_entry(entry, diff, schema):
+    """Apply renames and re-run the local generators against the new schema."""
+    entry["yaml"], entry["queries"], _ = rename_references(entry, diff)
+
+    try:
+        ir = build_ir(entry["yaml"], schema)
+    except UnsupportedQueryError:
+        ir = None
+    for dialect in entry["queries"]:
+        if ir is None or dialect not in GENERATORS:
+            continue
+        try:
+            entry["queries"][dialect] = lower(ir, dialect)
+        except UnsupportedQueryError:
+            # Keep the stored LLM generated query
+            pass
+    return entry
+
+
+def plan_migration(catalog, schema, renames=None):
+    """Plan every stored entry generated against another schema version."""
+    version = schema_hash(schema)
+    diffs = {}
+    plans = []
+    for entry in catalog.entries():
+        if entry["schema_hash"] == version:
+            continue
+        if entry["schema_hash"] not in diffs:
+            old_schema = catalog.load_schema(entry["schema_hash"])
+            diffs[entry["schema_hash"]] = (
+                diff_schemas(old_schema, schema, renames)
+                if old_schema is not None
+                else None
+            )
+        diff = diffs[entry["schema_hash"]]
+        if diff is None:
+            plans.append((entry, REGENERATE, "unknown schema version", None))
+        else:
+            plans.append((entry, *plan_entry(entry, diff, schema), diff))
+    return plans
+
+
+def migrate(
+    catalog,
+    schema,
+    regenerate,
+    renames=None,
+    concurrency=REGENERATE_CONCURRENCY,
+    dry_run=False,
+):
+    """
+    Bring the catalog up to date with a new schema. Entries are skipped, patched
+    locally or regenerated through regenerate(entry), in parallel.
+    """
+    plans = plan_migration(catalog, schema, renames)
+    # A dry run leaves the catalog untouched
+    version = schema_hash(schema) if dry_run else catalog.save_schema(schema)
+
+    def apply(plan):
+        entry, action, reason, diff = plan
+        result = {"id": entry["id"], "action": action, "reason": reason}
+        if dry_run:
+            return result
+        try:
+            if action == REGENERATE:
+                regenerate(entry)
+                # The workflow saves the entry only when generation succeeded
+                saved = catalog.load(entry["id"])
+                if saved is None or saved["schema_hash"] != version:
+                    raise RuntimeError("regenerated blueprint was not saved")
+            else:
+                if action == PATCH:
+                    entry = patch_entry(entry, diff, schema)
+                entry["schema_hash"] = version
+                catalog.save(entry)
+            result["status"] = "ok"
+        except Exception as e:
+            print(f"Error migrating {entry['id']}: {e}")
+            result["status"] = f"error: {e}"
+        return result
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(apply, plans))
+
+    summary = {action: 0 for action in (SKIP, PATCH, REGENERATE)}
+    for result in results:
+        summary[result["action"]] += 1
+    print(f"Schema migration to {version}: {summary}")
+    return {"schema_hash": version, "summary": summary, "entries": results}
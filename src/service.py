@@ -4,20 +4,27 @@ from fastapi.responses import HTMLResponse
 from dapr_agents import tool, ReActAgent
 from dotenv import load_dotenv
 from config import SQL_SCHEMAS, YAML_TEMPLATE_SAMPLE
+from budget import (
+    MAX_PROMPT_TOKENS,
+    abbreviate_blueprint,
+    compact_schema,
+    count_tokens,
+)
 
 load_dotenv()
 
 
+def fit_prompt(text, compact):
+    """Keep the text as is, compact it only when it exceeds MAX_PROMPT_TOKENS."""
+    if MAX_PROMPT_TOKENS and count_tokens(text) > MAX_PROMPT_TOKENS:
+        return compact(text)
+    return text
+
+
 @tool
 def generate_yaml(user_prompt: str) -> str:
     """Generate YAML configuration template content."""
     prompt = f"""
-    The database schemas are provided below:
-
-    ```
-    {SQL_SCHEMAS}
-    ```
-    
     Below is an example of YAML structured blueprint: (for reference only)
 
     ```
@@ -25,10 +32,11 @@ def generate_yaml(user_prompt: str) -> str:
     ```
 
     Generate a YAML structured blueprint, output only YAML content (no formatting, no triple backticks, etc.),
-    follows closely the database schemas above and the user's prompt in natural language below:
+    follows closely the database schemas in your instructions and the user's prompt in natural language below:
     
     User's prompt: {user_prompt}
     """
+    print(f"--- generate_yaml prompt tokens: {count_tokens(prompt)}")
     return prompt
 
 
@@ -40,19 +48,14 @@ def generate_sql(yaml_string: str) -> str:
         YAML configuration template is provided below:
         
         ```
-        {yaml_string}
+        {fit_prompt(yaml_string, abbreviate_blueprint)}
         ```
 
-        The database schemas are provided below:
-
-        ```
-        {SQL_SCHEMAS}
-        ```
-        
-        Generating SQL queries, prioritize performance and utilize techniques such as Common Table Expressions (CTEs) to enhance portability and readability.
+        Using the database schemas in your instructions, generating SQL queries, prioritize performance and utilize techniques such as Common Table Expressions (CTEs) to enhance portability and readability.
 
         Also generate Kibana query (KQL).
     """
+    print(f"--- generate_sql prompt tokens: {count_tokens(prompt)}")
     return prompt
 
 
@@ -63,7 +66,9 @@ react_agent = ReActAgent(
         """
         You are a Security AI Agent, an application health monitoring system.
         Your task is to take user prompts in natural language.
-        """
+        """,
+        # Sent once with the system prompt instead of on every tool call
+        f"The database schemas are: {fit_prompt(SQL_SCHEMAS, compact_schema)}",
     ],
     tools=[generate_yaml, generate_sql],
 )
@@ -0,0 +1,176 @@
+import asyncio
+import json
+import os
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+# --- Queue Configuration ---
+PUBSUB_BROKER = os.getenv("PUBSUB_BROKER", "dapr")  # dapr or memory
+PUBSUB_NAME = os.getenv("PUBSUB_NAME", "pubsub")
+REQUEST_TOPIC = os.getenv("REQUEST_TOPIC", "blueprint-requests")
+RESULT_TOPIC = os.getenv("RESULT_TOPIC", "blueprint-results")
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "4"))
+MAX_QUEUE_DEPTH = int(os.getenv("MAX_QUEUE_DEPTH", "100"))
+# Comma separated URL prefixes results may be posted to, empty disables callbacks
+CALLBACK_URL_PREFIXES = [
+    prefix.strip()
+    for prefix in os.getenv("CALLBACK_URL_PREFIXES", "").split(",")
+    if prefix.strip()
+]
+
+
+class QueueFullError(Exception):
+    pass
+
+
+def is_allowed_callback(url, prefixes=None):
+    """Only post results to the configured hosts, never to any client-supplied URL."""
+    prefixes = CALLBACK_URL_PREFIXES if prefixes is None else prefixes
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or parts.username or parts.password:
+        return False
+    for prefix in prefixes:
+        allowed = urlsplit(prefix)
+        # Compare the host exactly, so a prefix can not match a longer host name
+        if (
+            parts.scheme == allowed.scheme
+            and parts.netloc.lower() == allowed.netloc.lower()
+            and parts.path.startswith(allowed.path)
+        ):
+            return True
+    return False
+
+
+class InMemoryBroker:
+    """Local stand-in for Dapr pub/sub, delivers events to in-process subscribers."""
+
+    def __init__(self):
+        self.subscribers = defaultdict(list)
+
+    def subscribe(self, topic, handler):
+        self.subscribers[topic].append(handler)
+
+    async def publish(self, topic, data):
+        for handler in self.subscribers[topic]:
+            await handler(data)
+
+
+class DaprBroker:
+    """Publishes through the Dapr sidecar, subscriptions are routed by DaprApp."""
+
+    def __init__(self, pubsub_name=PUBSUB_NAME):
+        self.pubsub_name = pubsub_name
+
+    def subscribe(self, topic, handler):
+        # Dapr pushes events to the HTTP route registered with DaprApp.subscribe
+        pass
+
+    async def publish(self, topic, data):
+        from dapr.clients import DaprClient
+
+        def publish_event():
+            with DaprClient() as client:
+                client.publish_event(
+                    pubsub_name=self.pubsub_name,
+                    topic_name=topic,
+                    data=json.dumps(data),
+                    data_content_type="application/json",
+                )
+
+        await asyncio.to_thread(publish_event)
+
+
+def create_broker(kind=PUBSUB_BROKER):
+    if kind == "memory":
+        return InMemoryBroker()
+    return DaprBroker()
+
+
+class WorkerPool:
+    """
+    Consumes queued requests with bounded concurrency. Requests are rejected
+    with QueueFullError once the local queue is full, so callers can back off.
+    submit() returns a future that completes once the request is processed, so
+    delivery can be acknowledged only then.
+    """
+
+    def __init__(
+        self, process, concurrency=WORKER_CONCURRENCY, max_depth=MAX_QUEUE_DEPTH
+    ):
+        self.process = process
+        self.concurrency = concurrency
+        self.max_depth = max_depth
+        self.queue = None
+        self.workers = []
+        self.in_flight = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.max_depth)
+        self.workers = [
+            asyncio.create_task(self.work()) for _ in range(self.concurrency)
+        ]
+        print(f"Worker pool started with {self.concurrency} workers")
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        # Unprocessed requests are not acknowledged and get redelivered
+        while self.queue is not None and not self.queue.empty():
+            _, _, future = self.queue.get_nowait()
+            future.cancel()
+
+    def submit(self, request):
+        if self.queue is None:
+            raise QueueFullError("Worker pool is not running")
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((time.monotonic(), request, future))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise QueueFullError(f"Queue is full ({self.max_depth} requests)")
+        return future
+
+    async def work(self):
+        while True:
+            enqueued_at, request, future = await self.queue.get()
+            self.in_flight += 1
+            try:
+                await self.process(request)
+                self.processed += 1
+                if not future.done():
+                    future.set_result(None)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                self.failed += 1
+                print(f"Error processing request {request.get('request_id')}: {e}")
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self.in_flight -= 1
+                self.queue.task_done()
+                print(
+                    f"Request {request.get('request_id')} done after "
+                    f"{time.monotonic() - enqueued_at:.1f}s"
+                )
+
+    def metrics(self):
+        """Queue depth and utilization, for backpressure and autoscaling."""
+        depth = self.queue.qsize() if self.queue is not None else 0
+        return {
+            "queue_depth": depth,
+            "max_queue_depth": self.max_depth,
+            "in_flight": self.in_flight,
+            "concurrency": self.concurrency,
+            "utilization": (depth + self.in_flight) / self.concurrency,
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+        }
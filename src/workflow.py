@@ -1,11 +1,31 @@
 # from dapr_agents.workflow import WorkflowApp, workflow, task
+import asyncio
+import math
+import uuid
+import requests
 import dapr.ext.workflow as wf
+from dapr.ext.fastapi import DaprApp
 from dotenv import load_dotenv
 from openai import OpenAI
-from fastapi import FastAPI
-from fastapi.responses import HTMLResponse
+from fastapi import Body, FastAPI, Request
+from fastapi.responses import HTMLResponse, JSONResponse
 from utils import remove_double_quotes
 from config import SQL_SCHEMAS, YAML_TEMPLATE_SAMPLE
+from catalog import Catalog
+from budget import TokenBudget, abbreviate_blueprint, compact_schema, is_compacted
+from latency import ACTIVITY_TIMEOUT, WORKFLOW_TIMEOUT, LatencyTracker, hedged_call
+from query_ir import UnsupportedQueryError, build_ir, lower
+from schema_diff import migrate
+from worker import (
+    PUBSUB_BROKER,
+    PUBSUB_NAME,
+    REQUEST_TOPIC,
+    RESULT_TOPIC,
+    QueueFullError,
+    WorkerPool,
+    create_broker,
+    is_allowed_callback,
+)
 
 # Load environment variables
 load_dotenv()
@@ -13,7 +33,33 @@ load_dotenv()
 # Initialize Workflow Instance
 wfr = wf.WorkflowRuntime()
 
+# Token and cost accounting shared by all activities
+budget = TokenBudget()
+# LLM latency per stage, drives the hedging delay
+latency = LatencyTracker()
+# Stored blueprints and queries, for incremental regeneration on schema changes
+catalog = Catalog()
+# Background schema migrations by job id
+migrations = {}
+
+# Seconds between client disconnect checks in /run
+DISCONNECT_POLL_INTERVAL = 1
+
 MODEL = "gpt-4o"
+# Queries generated for each blueprint, see query_ir.GENERATORS for local generators
+QUERY_DIALECTS = ["sqlite", "postgres", "kql", "promql", "spl"]
+DIALECT_PROMPTS = {
+    "sqlite": """Generate SQLite SQL query only (no formatting, no backticks, no markdown, etc.), prioritize performance
+                    and utilize techniques such as Common Table Expressions (CTEs) to enhance portability and readability.""",
+    "postgres": """Generate PostgreSQL query only (no formatting, no backticks, no markdown, etc.), prioritize performance
+                    and utilize techniques such as Common Table Expressions (CTEs) to enhance portability and readability.""",
+    "kql": """Generate Kibana KQL query only (no formatting, no backticks, no markdown, etc.), prioritize performance
+                    and enhance portability and readability.""",
+    "promql": """Generate PromQL query only (no formatting, no backticks, no markdown, etc.), each table is exported
+                    as one series per numeric column named <table>_<column>, other columns are labels.""",
+    "spl": """Generate Splunk SPL query only (no formatting, no backticks, no markdown, etc.), each table is a
+                    sourcetype with the same name, prioritize performance and readability.""",
+}
 DEFAULT_PROMPT = f"""
 You are a Security AI Agent, an application health monitoring system.
 You have access to database schemas and YAML blueprint examples for generating SQL, KQL, and PromQL queries.
@@ -24,44 +70,89 @@ The database schemas are provided below:
 {SQL_SCHEMAS}
 ```
 """
+COMPACT_PROMPT = DEFAULT_PROMPT.replace(SQL_SCHEMAS, compact_schema(SQL_SCHEMAS))
+
+
+def base_prompt(level):
+    return COMPACT_PROMPT if is_compacted(level, "schema") else DEFAULT_PROMPT
+
+
+def complete(ctx, stage, tenant, render):
+    """Fit the prompt into the token budget, call the model and record its usage."""
+    prompt, level = budget.fit(render, tenant, ctx.workflow_id, MODEL)
+    # Deadlines are enforced by hedged_call, a late answer is dropped
+    client = OpenAI(timeout=ACTIVITY_TIMEOUT, max_retries=0)
+
+    def call():
+        response = client.chat.completions.create(
+            messages=[{"role": "user", "content": prompt}],
+            model=MODEL,
+        )
+        # Every call is billed, including the losing hedged request
+        budget.record(stage, tenant, ctx.workflow_id, MODEL, response.usage, level)
+        return response.choices[0].message.content
+
+    return hedged_call(call, stage, latency)
 
 
 # Define Workflow logic
 @wfr.workflow(name="task_chain_workflow")
-def task_chain_workflow(ctx: wf.DaprWorkflowContext, query: str):
-    yaml = yield ctx.call_activity(generate_yaml, input=query)
-    sql = yield ctx.call_activity(generate_sql, input=yaml)
-    kql = yield ctx.call_activity(generate_kql, input=yaml)
-    return yaml + "\n\n---\n\n" + sql + "\n\n---\n\n" + kql
+def task_chain_workflow(ctx: wf.DaprWorkflowContext, wf_input: dict):
+    tenant = wf_input["tenant"]
+    yaml = yield ctx.call_activity(
+        generate_yaml, input={"query": wf_input["query"], "tenant": tenant}
+    )
+    if yaml.startswith("Error in"):
+        # No blueprint to generate queries from
+        return yaml
+    ir = yield ctx.call_activity(build_query_ir, input=yaml)
+    queries = yield wf.when_all(
+        [
+            ctx.call_activity(
+                generate_query,
+                input={"yaml": yaml, "ir": ir, "dialect": dialect, "tenant": tenant},
+            )
+            for dialect in QUERY_DIALECTS
+        ]
+    )
+    yield ctx.call_activity(
+        save_blueprint,
+        input={
+            "id": wf_input.get("catalog_id") or ctx.instance_id,
+            "query": wf_input["query"],
+            "tenant": tenant,
+            "yaml": yaml,
+            "queries": dict(zip(QUERY_DIALECTS, queries)),
+        },
+    )
+    return "\n\n---\n\n".join(
+        [yaml]
+        + [f"-- {dialect}\n{query}" for dialect, query in zip(QUERY_DIALECTS, queries)]
+    )
 
 
 # Activity 1
 @wfr.activity(name="step1")
-def generate_yaml(ctx, activity_input: str):
-    try:
-        client = OpenAI()
-        response = client.chat.completions.create(
-            messages=[
-                {
-                    "role": "user",
-                    "content": f"""{DEFAULT_PROMPT}
-
+def generate_yaml(ctx, activity_input: dict):
+    def render(level):
+        example = ""
+        if not is_compacted(level, "examples"):
+            example = f"""
                     Below is one example of a YAML structured blueprint: (for reference only)
 
                     ```
                     {YAML_TEMPLATE_SAMPLE}
                     ```
-
+"""
+        return f"""{base_prompt(level)}
+{example}
                     Generate a new YAML structured blueprint, output only YAML content (no formatting, no triple backticks, etc.),
                     follows closely the database schemas above and the user's prompt in natural language below:
                     
-                    User's prompt: {activity_input}""",
-                }
-            ],
-            model=MODEL,
-        )
-        content = response.choices[0].message.content
-        return content
+                    User's prompt: {activity_input["query"]}"""
+
+    try:
+        return complete(ctx, "generate_yaml", activity_input["tenant"], render)
     except Exception as e:
         print(f"Error in generate_yaml: {e}")
         return f"Error in generate_yaml: {e}"
@@ -69,87 +160,201 @@ def generate_yaml(ctx, activity_input: str):
 
 # Activity 2
 @wfr.activity(name="step2")
-def generate_sql(ctx, yaml_template: str):
+def build_query_ir(ctx, yaml_template: str):
     try:
-        client = OpenAI()
-        response = client.chat.completions.create(
-            messages=[
-                {
-                    "role": "user",
-                    "content": f"""{DEFAULT_PROMPT}
-
-                    The generated YAML structured blueprint is below:
-
-                    ```
-                    {yaml_template}
-                    ```
-                    
-                    Generate SQL query only (no formatting, no backticks, no markdown, etc.), prioritize performance
-                    and utilize techniques such as Common Table Expressions (CTEs) to enhance portability and readability.
-                    """,
-                }
-            ],
-            model=MODEL,
-        )
-        content = response.choices[0].message.content
-        print(f"--- SQL QUERY: {content}")
-        return content
+        return build_ir(yaml_template, SQL_SCHEMAS)
     except Exception as e:
-        print(f"Error in generate_sql: {e}")
-        return f"Error in generate_sql: {e}"
+        # Every dialect falls back to the LLM
+        print(f"No query IR for blueprint: {e}")
+        return None
 
 
 # Activity 3
 @wfr.activity(name="step3")
-def generate_kql(ctx, yaml_template: str):
+def generate_query(ctx, activity_input: dict):
+    dialect = activity_input["dialect"]
     try:
-        client = OpenAI()
-        response = client.chat.completions.create(
-            messages=[
-                {
-                    "role": "user",
-                    "content": f"""{DEFAULT_PROMPT}
+        content = lower(activity_input["ir"], dialect)
+        print(f"--- {dialect.upper()} QUERY (generated locally): {content}")
+        return content
+    except UnsupportedQueryError as e:
+        print(f"Falling back to LLM for {dialect}: {e}")
+
+    reference = ""
+    if activity_input["ir"] is not None:
+        # Keep the semantics consistent with the locally generated dialects
+        reference = f"""
+                    Keep the same filters, time window, grouping and thresholds as this reference SQL query:
+
+                    ```
+                    {lower(activity_input["ir"], "postgres")}
+                    ```
+"""
+
+    def render(level):
+        yaml_template = activity_input["yaml"]
+        if is_compacted(level, "blueprint"):
+            yaml_template = abbreviate_blueprint(yaml_template)
+        return f"""{base_prompt(level)}
 
                     The generated YAML structured blueprint is below:
 
                     ```
                     {yaml_template}
                     ```
-                    
-                    Generate Kibana KQL query only (no formatting, no backticks, no markdown, etc.), prioritize performance
-                    and enhance portability and readability.
-                    """,
-                }
-            ],
-            model=MODEL,
-        )
-        content = response.choices[0].message.content
-        print(f"--- KQL QUERY: {content}")
+                    {reference}
+                    {DIALECT_PROMPTS[dialect]}
+                    """
+
+    try:
+        content = complete(ctx, f"generate_{dialect}", activity_input["tenant"], render)
+        print(f"--- {dialect.upper()} QUERY: {content}")
         return content
     except Exception as e:
-        print(f"Error in generate_sql: {e}")
-        return f"Error in generate_sql: {e}"
+        print(f"Error in generate_query ({dialect}): {e}")
+        return f"Error in generate_query ({dialect}): {e}"
 
 
-app = FastAPI()
+# Activity 4
+@wfr.activity(name="step4")
+def save_blueprint(ctx, entry: dict):
+    if entry["yaml"].startswith("Error in"):
+        return
+    try:
+        entry["schema_hash"] = catalog.save_schema(SQL_SCHEMAS)
+        catalog.save(entry)
+    except Exception as e:
+        print(f"Error in save_blueprint: {e}")
 
 
-@app.get("/run")
-async def run(q: str):
+def schedule_workflow(query, tenant, instance_id=None, catalog_id=None):
+    wf_client = wf.DaprWorkflowClient()
+    if instance_id and wf_client.get_workflow_state(instance_id, fetch_payloads=False):
+        # Redelivered request, wait for the instance already running
+        print(f"Workflow already scheduled. Instance ID: {instance_id}")
+        return instance_id
+
+    wf_input = {"query": query, "tenant": tenant}
+    if catalog_id:
+        wf_input["catalog_id"] = catalog_id
+    instance_id = wf_client.schedule_new_workflow(
+        workflow=task_chain_workflow,
+        input=wf_input,
+        instance_id=instance_id,
+    )
+    print(f"Workflow started. Instance ID: {instance_id}")
+    return instance_id
+
+
+def terminate_workflow(instance_id, reason):
+    try:
+        wf.DaprWorkflowClient().terminate_workflow(instance_id, output=reason)
+        print(f"Workflow terminated ({reason}). Instance ID: {instance_id}")
+    except Exception as e:
+        print(f"Error terminating workflow {instance_id}: {e}")
+    finally:
+        budget.release(instance_id)
+
+
+def wait_for_output(instance_id, timeout=WORKFLOW_TIMEOUT):
+    """Wait for the workflow output, terminating the instance when it times out."""
+    wf_client = wf.DaprWorkflowClient()
     try:
-        wf_client = wf.DaprWorkflowClient()
-        instance_id = wf_client.schedule_new_workflow(
-            workflow=task_chain_workflow, input=q
+        state = wf_client.wait_for_workflow_completion(
+            instance_id,
+            # 0 means no timeout for the Dapr SDK
+            timeout_in_seconds=max(1, math.ceil(timeout)),
         )
+    except TimeoutError:
+        terminate_workflow(instance_id, "workflow timeout")
+        raise TimeoutError(f"Workflow did not complete within {timeout:g}s")
+    print(f"Workflow completed! Status: {state.runtime_status}")
+    budget.release(instance_id)
+
+    # wfr.shutdown()
+
+    output = state.serialized_output.replace("\\n", "\n").replace("\\t", "\t")
+    return remove_double_quotes(output)
+
+
+def run_workflow(query, tenant, instance_id=None, catalog_id=None):
+    """Run task_chain_workflow to completion and return its output."""
+    return wait_for_output(schedule_workflow(query, tenant, instance_id, catalog_id))
 
-        print(f"Workflow started. Instance ID: {instance_id}")
-        state = wf_client.wait_for_workflow_completion(instance_id)
-        print(f"Workflow completed! Status: {state.runtime_status}")
 
-        # wfr.shutdown()
+def regenerate_blueprint(entry):
+    """Regenerate a stored blueprint through the full workflow, in place."""
+    run_workflow(entry["query"], entry["tenant"], catalog_id=entry["id"])
+
+
+async def process_request(request):
+    """Worker pool handler for queued requests, answers on the result topic."""
+    try:
+        output = await asyncio.to_thread(
+            run_workflow, request["query"], request["tenant"], request["request_id"]
+        )
+        result = {"request_id": request["request_id"], "status": "completed"}
+        result["output"] = output
+    except Exception as e:
+        print(f"Error in process_request: {e}")
+        result = {"request_id": request["request_id"], "status": "failed"}
+        result["error"] = str(e)
+
+    await broker.publish(RESULT_TOPIC, result)
+    callback_url = request.get("callback_url")
+    if callback_url:
+        # Events can be published to the topic without going through /requests
+        if not is_allowed_callback(callback_url):
+            print(f"Skipping callback to disallowed URL: {callback_url}")
+            return
+        await asyncio.to_thread(
+            requests.post,
+            callback_url,
+            json=result,
+            timeout=10,
+            allow_redirects=False,
+        )
 
-        output = state.serialized_output.replace("\\n", "\n").replace("\\t", "\t")
-        output = remove_double_quotes(output)
+
+async def enqueue_request(request):
+    """In-memory broker subscriber, the answer goes to the result topic."""
+    future = pool.submit(request)
+    future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+
+broker = create_broker()
+pool = WorkerPool(process_request)
+broker.subscribe(REQUEST_TOPIC, enqueue_request)
+
+app = FastAPI()
+dapr_app = DaprApp(app)
+
+
+@app.on_event("startup")
+async def start_workers():
+    await pool.start()
+
+
+@app.on_event("shutdown")
+async def stop_workers():
+    await pool.stop()
+
+
+@app.get("/run")
+async def run(request: Request, q: str, tenant: str = "default"):
+    try:
+        instance_id = await asyncio.to_thread(schedule_workflow, q, tenant)
+        waiter = asyncio.create_task(asyncio.to_thread(wait_for_output, instance_id))
+        while not waiter.done():
+            if await request.is_disconnected():
+                # Nobody is waiting for the answer anymore
+                await asyncio.to_thread(
+                    terminate_workflow, instance_id, "client disconnected"
+                )
+                return HTMLResponse(content="", status_code=499)
+            await asyncio.wait({waiter}, timeout=DISCONNECT_POLL_INTERVAL)
+
+        output = waiter.result()
         return HTMLResponse(
             content=f"<pre style='text-wrap: wrap;'>{output}</pre>", status_code=200
         )
@@ -163,3 +368,117 @@ async def run(q: str):
         return HTMLResponse(
             content=f"<h1>Error in /run</h1><p>{e}</p>", status_code=500
         )
+
+
+@app.post("/requests")
+async def submit_request(q: str, tenant: str = "default", callback_url: str = None):
+    """Queue a request, the result is published on the result topic (and callback_url)."""
+    if callback_url and not is_allowed_callback(callback_url):
+        return JSONResponse(
+            content={"error": "callback_url is not in CALLBACK_URL_PREFIXES"},
+            status_code=400,
+        )
+
+    metrics = pool.metrics()
+    if metrics["queue_depth"] >= metrics["max_queue_depth"]:
+        return JSONResponse(
+            content={"error": "Queue is full, retry later", **metrics},
+            status_code=429,
+            headers={"Retry-After": "5"},
+        )
+
+    request = {
+        "request_id": str(uuid.uuid4()),
+        "query": q,
+        "tenant": tenant,
+        "callback_url": callback_url,
+    }
+    try:
+        await broker.publish(REQUEST_TOPIC, request)
+    except QueueFullError as e:
+        return JSONResponse(
+            content={"error": str(e)}, status_code=429, headers={"Retry-After": "5"}
+        )
+    return JSONResponse(
+        content={"request_id": request["request_id"], "status": "queued"},
+        status_code=202,
+    )
+
+
+if PUBSUB_BROKER == "dapr":
+
+    @dapr_app.subscribe(pubsub=PUBSUB_NAME, topic=REQUEST_TOPIC)
+    async def on_request(event: dict):
+        try:
+            future = pool.submit(event["data"])
+        except QueueFullError as e:
+            # Dapr redelivers the event later, with its retry policy
+            print(f"Backpressure on {REQUEST_TOPIC}: {e}")
+            return {"status": "RETRY"}
+
+        # Acknowledge only once processed, so a crash or redeploy redelivers it
+        await asyncio.wait({future})
+        if future.cancelled() or future.exception() is not None:
+            return {"status": "RETRY"}
+        return {"status": "SUCCESS"}
+
+
+@app.get("/queue")
+async def queue():
+    return pool.metrics()
+
+
+@app.post("/catalog/migrate")
+async def migrate_catalog(
+    dry_run: bool = False, renames: dict = Body(None, embed=True)
+):
+    """
+    Regenerate or patch only the stored blueprints affected by SQL_SCHEMAS changes.
+    Column renames are declared as {"renames": {table: {old: new}}}. A dry run
+    returns the plan, otherwise the migration runs in the background.
+    """
+    if dry_run:
+        return await asyncio.to_thread(
+            migrate, catalog, SQL_SCHEMAS, regenerate_blueprint, renames, dry_run=True
+        )
+
+    # Two migrations would regenerate the same entries concurrently
+    running = [
+        job["job_id"] for job in migrations.values() if job["status"] == "running"
+    ]
+    if running:
+        return JSONResponse(
+            content={"error": "A migration is already running", "job_id": running[0]},
+            status_code=409,
+        )
+    job_id = str(uuid.uuid4())
+    job = migrations[job_id] = {"job_id": job_id, "status": "running"}
+
+    async def run_migration():
+        try:
+            job["result"] = await asyncio.to_thread(
+                migrate, catalog, SQL_SCHEMAS, regenerate_blueprint, renames
+            )
+            job["status"] = "completed"
+        except Exception as e:
+            print(f"Error in migration {job_id}: {e}")
+            job["status"] = "failed"
+            job["error"] = str(e)
+
+    job["task"] = asyncio.create_task(run_migration())
+    return JSONResponse(
+        content={"job_id": job_id, "status": "running"}, status_code=202
+    )
+
+
+@app.get("/catalog/migrate/{job_id}")
+async def migration_status(job_id: str):
+    job = migrations.get(job_id)
+    if job is None:
+        return JSONResponse(content={"error": "Unknown job"}, status_code=404)
+    return {key: value for key, value in job.items() if key != "task"}
+
+
+@app.get("/usage")
+async def usage():
+    return budget.export()